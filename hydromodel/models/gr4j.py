@@ -1,4 +1,5 @@
 import math
+from functools import lru_cache
 from typing import Optional, Tuple
 import numpy as np
 from numba import jit
@@ -63,7 +64,7 @@ def production(
         s_level = 0.6 * x1
 
     # s_level should not be larger than x1
-    s_level = np.clip(s_level, a_min=np.full(s_level.shape, 0.0), a_max=x1)
+    s_level = np.clip(s_level, a_min=0.0, a_max=x1)
 
     # Calculate the fraction of net precipitation that is stored
     precip_store = calculate_precip_store(s_level, precip_net, x1)
@@ -75,11 +76,11 @@ def production(
     # removing evaporation
     s_update = s_level - evap_store + precip_store
     # s_level should not be larger than self.x1
-    s_update = np.clip(s_update, a_min=np.full(s_update.shape, 0.0), a_max=x1)
+    np.clip(s_update, a_min=0.0, a_max=x1, out=s_update)
 
     # Update the storage again to reflect percolation out of the store
     perc = calculate_perc(s_update, x1)
-    s_update = s_update - perc
+    s_update -= perc
     # perc is always lower than S because of the calculation itself, so we don't need clamp here anymore.
 
     # The precip. for routing is the sum of the rainfall which
@@ -89,36 +90,51 @@ def production(
     return current_runoff, evap_store, s_update
 
 
-# @jit
-@jit(nopython=True)
 def s_curves1(t, x4):
     """
     Unit hydrograph ordinates for UH1 derived from S-curves.
-    """
 
-    if t <= 0:
-        return 0
-    elif t < x4:
-        return (t / x4) ** 2.5
-    else:  # t >= x4
-        return 1
+    t could be a scalar or a np.array; t / x4 is clipped to [0, 1] so that all cases are calculated at once
+    """
+    return np.clip(np.asarray(t) / x4, 0.0, 1.0) ** 2.5
 
 
-# @jit
-@jit(nopython=True)
 def s_curves2(t, x4):
     """
     Unit hydrograph ordinates for UH2 derived from S-curves.
+
+    t could be a scalar or a np.array; t / x4 is clipped to [0, 2] so that all cases are calculated at once
+    """
+    u = np.clip(np.asarray(t) / x4, 0.0, 2.0)
+    return np.where(u < 1.0, 0.5 * u**2.5, 1.0 - 0.5 * (2.0 - u) ** 2.5)
+
+
+@lru_cache(maxsize=256)
+def uh_gr4j_ordinates(x4: float):
     """
+    UH1 and UH2 of one basin
 
-    if t <= 0:
-        return 0
-    elif t < x4:
-        return 0.5 * (t / x4) ** 2.5
-    elif t < 2 * x4:
-        return 1 - 0.5 * (2 - t / x4) ** 2.5
-    else:  # t >= x4
-        return 1
+    In calibration, the model is run many times and x4 is often the same while other parameters change,
+    so the results are cached; the arrays are read-only because they are shared by all calls with same x4.
+
+    Parameters
+    ----------
+    x4
+        the fourth parameter of GR4J (time base of the unit hydrographs)
+
+    Returns
+    -------
+    tuple
+        UH1 and UH2
+    """
+    n_uh1 = int(math.ceil(x4))
+    n_uh2 = int(math.ceil(2.0 * x4))
+    # the ordinates are the differences of S-curves at t = 0, 1, ..., n_uh
+    uh1_ordinate = np.diff(s_curves1(np.arange(n_uh1 + 1), x4))
+    uh2_ordinate = np.diff(s_curves2(np.arange(n_uh2 + 1), x4))
+    uh1_ordinate.flags.writeable = False
+    uh2_ordinate.flags.writeable = False
+    return uh1_ordinate, uh2_ordinate
 
 
 def uh_gr4j(x4):
@@ -132,20 +148,12 @@ def uh_gr4j(x4):
     Returns
     -------
     list
-        UH1s and UH2s for all basins
+        UH1s and UH2s for all basins; the arrays are read-only
     """
     uh1_ordinates = []
     uh2_ordinates = []
     for i in range(len(x4)):
-        n_uh1 = int(math.ceil(x4[i]))
-        n_uh2 = int(math.ceil(2.0 * x4[i]))
-        uh1_ordinate = np.zeros(n_uh1)
-        uh2_ordinate = np.zeros(n_uh2)
-        for t in range(1, n_uh1 + 1):
-            uh1_ordinate[t - 1] = s_curves1(t, x4[i]) - s_curves1(t - 1, x4[i])
-
-        for t in range(1, n_uh2 + 1):
-            uh2_ordinate[t - 1] = s_curves2(t, x4[i]) - s_curves2(t - 1, x4[i])
+        uh1_ordinate, uh2_ordinate = uh_gr4j_ordinates(float(x4[i]))
         uh1_ordinates.append(uh1_ordinate)
         uh2_ordinates.append(uh2_ordinate)
 
@@ -171,14 +179,16 @@ def routing(q9: np.array, q1: np.array, x2, x3, r_level: Optional[np.array] = No
     if r_level is None:
         r_level = 0.7 * x3
     # r_level should not be larger than self.x3
-    r_level = np.clip(r_level, a_min=np.full(r_level.shape, 0.0), a_max=x3)
+    r_level = np.clip(r_level, a_min=0.0, a_max=x3)
     groundwater_ex = x2 * (r_level / x3) ** 3.5
-    r_updated = np.maximum(np.full(r_level.shape, 0.0), r_level + q9 + groundwater_ex)
+    r_updated = r_level + q9 + groundwater_ex
+    np.maximum(r_updated, 0.0, out=r_updated)
 
     qr = r_updated * (1.0 - (1.0 + (r_updated / x3) ** 4) ** -0.25)
-    r_updated = r_updated - qr
+    r_updated -= qr
 
-    qd = np.maximum(np.full(groundwater_ex.shape, 0.0), q1 + groundwater_ex)
+    qd = q1 + groundwater_ex
+    np.maximum(qd, 0.0, out=qd)
     q = qr + qd
     return q, r_updated
 
@@ -12,9 +12,23 @@ import logging
 from typing import Union
 import numpy as np
 from numba import jit
+from scipy import signal
 from scipy.special import gamma
 
 from hydromodel.models.model_config import MODEL_PARAM_DICT
+from hydromodel.models.xaj_numba import (
+    QG,
+    QI,
+    basin_block,
+    csl_route,
+    generation_core,
+    linear_reservoir_route,
+    numba_threads,
+    raise_kernel_error,
+    sources5mm_core,
+    xaj_constants,
+    xaj_core,
+)
 
 PRECISION = 1e-5
 
@@ -49,17 +63,16 @@ def calculate_evap(lm, c, wu0, wl0, prcp, pet) -> tuple[np.array, np.array, np.a
     tuple[np.array,np.array,np.array]
         eu/el/ed are evaporation from upper/lower/deeper layer, respectively
     """
-    eu = np.where(wu0 + prcp >= pet, pet, wu0 + prcp)
-    ed = np.where((wl0 < c * lm) & (wl0 < c * (pet - eu)), c * (pet - eu) - wl0, 0.0)
-    el = np.where(
-        wu0 + prcp >= pet,
-        0.0,
-        np.where(
-            wl0 >= c * lm,
-            (pet - eu) * wl0 / lm,
-            np.where(wl0 >= c * (pet - eu), c * (pet - eu), wl0),
-        ),
-    )
+    # common terms are calculated only once; min/max replace the nested where chains,
+    # so only one branch is evaluated for each term
+    eu = np.minimum(wu0 + prcp, pet)
+    # the evaporation capacity left for lower and deep layers; it is 0 when upper layer is enough
+    pet_left = pet - eu
+    c_pet_left = c * pet_left
+    lower_enough = wl0 >= c * lm
+    ed = np.where(lower_enough, 0.0, np.maximum(c_pet_left - wl0, 0.0))
+    # as soil moisture is non-negative, el is 0 automatically when pet_left is 0
+    el = np.where(lower_enough, pet_left * wl0 / lm, np.minimum(wl0, c_pet_left))
     return eu, el, ed
 
 
@@ -89,20 +102,19 @@ def calculate_prcp_runoff(b, im, wm, w0, pe) -> tuple[np.array, np.array]:
     tuple[np.array,np.array]
         r -- runoff; r_im -- runoff of impervious part
     """
-    wmm = wm * (1.0 + b)
-    a = wmm * (1.0 - (1.0 - w0 / wm) ** (1.0 / (1.0 + b)))
+    one_pb = 1.0 + b
+    wmm = wm * one_pb
+    a = wmm * (1.0 - (1.0 - w0 / wm) ** (1.0 / one_pb))
     if np.isnan(a).any():
         raise ArithmeticError("Please check if w0>wm or b is a negative value!")
+    # r = pe - (wm - w0) when pe + a >= wmm, i.e. all the basin area generates runoff
+    r_cal = pe - (wm - w0)
+    # otherwise, r = pe - (wm - w0) + wm * (1 - (a + pe) / wmm) ** (1 + b)
+    a_pe = a + pe
     r_cal = np.where(
-        pe > 0.0,
-        np.where(
-            pe + a < wmm,
-            # 1e-5 is a precision which we set to guarantee float's calculation is correct
-            pe - (wm - w0) + wm * (1.0 - np.minimum(a + pe, wmm) / wmm) ** (1.0 + b),
-            pe - (wm - w0),
-        ),
-        np.full(pe.shape, 0.0),
+        a_pe < wmm, r_cal + wm * (1.0 - np.minimum(a_pe, wmm) / wmm) ** one_pb, r_cal
     )
+    r_cal = np.where(pe > 0.0, r_cal, 0.0)
     r = np.maximum(r_cal, 0.0)
     # separate impervious part with the other
     r_im_cal = pe * im
@@ -152,22 +164,22 @@ def calculate_w_storage(
     # pe<=0: no additional water, just remove evapotranspiration,
     # but note the case: e >= p > 0
     # (1) if wu0 + p > e, then e = eu (2) else, wu must be zero
-    wu = np.where(
-        pe > 0.0,
-        np.where(wu0 + pe - r < um, wu0 + pe - r, um),
-        np.where(wu0 + pe > 0.0, wu0 + pe, 0.0),
-    )
-    # calculate wd before wl because it is easier to cal using where statement
-    wd = np.where(
-        pe > 0.0,
-        np.where(wu0 + wl0 + pe - r > um + lm, wu0 + wl0 + wd0 + pe - r - um - lm, wd0),
-        wd0 - ed,
-    )
+    pe_positive = pe > 0.0
+    wu0_pe = wu0 + pe
+    wu0_pe_r = wu0_pe - r
+    wu = np.where(pe_positive, np.minimum(wu0_pe_r, um), np.maximum(wu0_pe, 0.0))
+    # all water in the three layers after runoff is removed
+    w_total = wu0 + wl0 + wd0 + pe - r
+    # calculate wd before wl because it is easier to cal using where statement;
+    # water exceeding um + lm goes to deep layer, i.e. wu0 + wl0 + pe - r > um + lm <=> w_excess > wd0
+    w_excess = w_total - um - lm
+    wd = np.where(pe_positive, np.maximum(w_excess, wd0), wd0 - ed)
     # water balance (equation 2.2 in Page 13, also shown in Page 23)
     # if wu0 + p > e, then e = eu; else p must be used in upper layer,
     # so no matter what the case is, el didn't include p, neither ed
-    wl = np.where(pe > 0.0, wu0 + wl0 + wd0 + pe - r - wu - wd, wl0 - el)
+    wl = np.where(pe_positive, w_total - wu - wd, wl0 - el)
     # the water storage should be in reasonable range
+    # they are not clipped in place, as um, lm and dm may be broadcast to a larger shape
     wu_ = np.clip(wu, a_min=0.0, a_max=um)
     wl_ = np.clip(wl, a_min=0.0, a_max=lm)
     wd_ = np.clip(wd, a_min=0.0, a_max=dm)
@@ -285,8 +297,11 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
         all variables are numpy array
 
     """
+    # the exponents used below
+    one_pex = 1.0 + ex
+    inv_1pex = 1.0 / one_pex
     # maximum free water storage capacity in a basin
-    ms = sm * (1.0 + ex)
+    ms = sm * one_pex
     if fr0 is None:
         fr0 = 0.1
     if s0 is None:
@@ -325,8 +340,8 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
     ss[fr_mask] = fr0[fr_mask] * s0[fr_mask] / fr[fr_mask]
 
     if book == "HF":
-        ss = np.minimum(ss, sm)
-        au = ms * (1.0 - (1.0 - ss / sm) ** (1.0 / (1.0 + ex)))
+        ss = np.minimum(ss, sm, out=ss)
+        au = ms * (1.0 - (1.0 - ss / sm) ** inv_1pex)
         if np.isnan(au).any():
             raise ValueError(
                 "Error: NaN values detected. Try set clip function or check your data!!!"
@@ -349,13 +364,13 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
                         - np.minimum(pe[fr_mask] + au[fr_mask], ms[fr_mask])
                         / ms[fr_mask]
                     )
-                    ** (1 + ex[fr_mask])
+                    ** one_pex[fr_mask]
                 )
             ),
             # equation 2-86 in HF
             fr[fr_mask] * (pe[fr_mask] + ss[fr_mask] - sm[fr_mask]),
         )
-        rs = np.minimum(rs, r)
+        rs = np.minimum(rs, r, out=rs)
 
         # ri's mask is not same as rs's, because last period's s may not be 0
         # and in this time, ri and rg could be larger than 0
@@ -363,16 +378,16 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
         # when r==0, then s will be equal to last period's
         # equation 2-87 in HF, some free water leave or save, so we update free water storage
         s[fr_mask] = ss[fr_mask] + (r[fr_mask] - rs[fr_mask]) / fr[fr_mask]
-        s = np.minimum(s, sm)
+        s = np.minimum(s, sm, out=s)
         if np.isnan(s).any():
             raise ArithmeticError("Please check fr's data! there may be 0.0")
 
     elif book == "EH":
         # smmf should be with correpond with s
         smmf = ms * (1 - (1 - fr) ** (1 / ex))
-        smf = smmf / (1 + ex)
-        ss = np.minimum(ss, smf)
-        au = smmf * (1 - (1 - ss / smf) ** (1 / (1 + ex)))
+        smf = smmf / one_pex
+        ss = np.minimum(ss, smf, out=ss)
+        au = smmf * (1 - (1 - ss / smf) ** inv_1pex)
         if np.isnan(au).any():
             raise ValueError(
                 "Error: NaN values detected. Try set clip function or check your data!!!"
@@ -392,14 +407,14 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
                     - np.minimum(pe[fr_mask] + au[fr_mask], smmf[fr_mask])
                     / smmf[fr_mask]
                 )
-                ** (ex[fr_mask] + 1)
+                ** one_pex[fr_mask]
             )
             * fr[fr_mask],
             (pe[fr_mask] + ss[fr_mask] - smf[fr_mask]) * fr[fr_mask],
         )
-        rs = np.minimum(rs, r)
+        rs = np.minimum(rs, r, out=rs)
         s[fr_mask] = ss[fr_mask] + (r[fr_mask] - rs[fr_mask]) / fr[fr_mask]
-        s = np.minimum(s, smf)
+        s = np.minimum(s, smf, out=s)
     else:
         raise ValueError("Please set book as 'HF' or 'EH'!")
     # the following part is same for both HF and EH. Even the formula is different, but their meaning is same
@@ -417,6 +432,49 @@ def sources(pe, r, sm, ex, ki, kg, s0=None, fr0=None, book="HF") -> tuple:
     return (rs, ri, rg), (s1, fr)
 
 
+def period_num_per_day(time_interval_hours):
+    """
+    Number of periods in one day; Ki and Kg are defined for 24 hours so they are converted with it
+
+    Parameters
+    ----------
+    time_interval_hours
+        the time interval of the model
+
+    Returns
+    -------
+    int
+        number of periods in one day; for non-divisible case, 1 is added
+    """
+    hours_per_day = 24
+    # Non-divisible case, add 1 to the period
+    residue_temp = hours_per_day % time_interval_hours
+    if residue_temp != 0:
+        residue_temp = 1
+    return int(hours_per_day / time_interval_hours) + residue_temp
+
+
+def num_5mm_pieces(runoff):
+    """
+    Number of <5mm pieces which the runoff of each basin is divided to
+
+    Parameters
+    ----------
+    runoff
+        runoff from xaj_generation
+
+    Returns
+    -------
+    np.array
+        number of pieces, same shape as runoff; it is 1 when runoff < 5
+    """
+    n = np.ones(runoff.shape, dtype=int)
+    large = runoff >= 5
+    # for non-divisible case, add 1 to the number
+    n[large] = (runoff[large] / 5).astype(int) + (runoff[large] % 5 != 0)
+    return n
+
+
 def sources5mm(
     pe,
     runoff,
@@ -465,37 +523,36 @@ def sources5mm(
         all variables are numpy array
     """
     # Convert Ki and Kg according to the time interval, as they are defined based on a 24-hour time interval
-    hours_per_day = 24
-    # Non-divisible case, add 1 to the period
-    residue_temp = hours_per_day % time_interval_hours
-    if residue_temp != 0:
-        residue_temp = 1
-    period_num_1d = int(hours_per_day / time_interval_hours) + residue_temp
+    period_num_1d = period_num_per_day(time_interval_hours)
     # When kss+kg>1, the square root becomes a complex number during even root calculation, which will cause an error here.
     # Also, be aware that the denominator may be 0, kss cannot be 0.
     # Restrict the value of kss+kg.
     kss_period = (1 - (1 - (ki + kg)) ** (1 / period_num_1d)) / (1 + kg / ki)
     kg_period = kss_period * kg / ki
 
+    # the exponents are same for all pieces, so calculate them before the loop
+    one_pex = 1.0 + ex
+    inv_1pex = 1.0 / one_pex
+    inv_ex = 1.0 / ex
     # Maximum free water storage capacity depth of the basin
-    smm = sm * (1 + ex)
+    smm = sm * one_pex
     if s0 is None:
         s0 = 0.50 * sm
     if fr0 is None:
         fr0 = 0.1
+    # the book is checked once rather than for every piece
+    if book not in ["HF", "EH"]:
+        raise NotImplementedError(
+            "We don't have this implementation! Please chose 'HF' or 'EH'!!"
+        )
+    hf = book == "HF"
     # don't use np.where here, because it will cause some warning
     fr = np.copy(fr0)
     fr_mask = runoff > 0.0
     fr[fr_mask] = runoff[fr_mask] / pe[fr_mask]
-    if np.all(runoff < 5):
-        n = 1
-    else:
-        # when modeling multiple basins, the number of divides is not the same, so we use the maximum number
-        r_max = np.max(runoff)
-        residue_temp = r_max % 5
-        if residue_temp != 0:
-            residue_temp = 1
-        n = int(r_max / 5) + residue_temp
+    # the number of divides is not the same for different basins,
+    # so the loop runs for the maximum number and a basin only updates in its first n pieces
+    n = num_5mm_pieces(runoff)
     rn = runoff / n
     pen = pe / n
     kss_d = (1 - (1 - (kss_period + kg_period)) ** (1 / n)) / (
@@ -513,7 +570,8 @@ def sources5mm(
     s_ds.append(s0)
     fr_ds.append(fr0)
 
-    for j in range(n):
+    for j in range(np.max(n, initial=1)):
+        active = j < n
         fr0_d = fr_ds[j]
         s0_d = s_ds[j]
         # equation 5-32 in HF, but strange, cause each period, rn/pen is same, fr_d should be same
@@ -526,11 +584,11 @@ def sources5mm(
 
         ss_d[fr_mask] = fr0_d[fr_mask] * s0_d[fr_mask] / fr_d[fr_mask]
 
-        if book == "HF":
-            ss_d = np.minimum(ss_d, sm)
+        if hf:
+            ss_d = np.minimum(ss_d, sm, out=ss_d)
             # ms = smm
-            au = smm * (1.0 - (1.0 - ss_d / sm) ** (1.0 / (1.0 + ex)))
-            if np.isnan(au).any():
+            au = smm * (1.0 - (1.0 - ss_d / sm) ** inv_1pex)
+            if np.isnan(au[active]).any():
                 raise ValueError(
                     "Error: NaN values detected. Try set clip function or check your data!!!"
                 )
@@ -550,22 +608,22 @@ def sources5mm(
                             - np.minimum(pen[fr_mask] + au[fr_mask], smm[fr_mask])
                             / smm[fr_mask]
                         )
-                        ** (1 + ex[fr_mask])
+                        ** one_pex[fr_mask]
                     )
                 ),
                 # equation 5-27 in HF
                 fr_d[fr_mask] * (pen[fr_mask] + ss_d[fr_mask] - sm[fr_mask]),
             )
-            rs_j = np.minimum(rs_j, rn)
+            rs_j = np.minimum(rs_j, rn, out=rs_j)
             s_d[fr_mask] = ss_d[fr_mask] + (rn[fr_mask] - rs_j[fr_mask]) / fr_d[fr_mask]
-            s_d = np.minimum(s_d, sm)
-
-        elif book == "EH":
-            smmf = smm * (1 - (1 - fr_d) ** (1 / ex))
-            smf = smmf / (1 + ex)
-            ss_d = np.minimum(ss_d, smf)
-            au = smmf * (1 - (1 - ss_d / smf) ** (1 / (1 + ex)))
-            if np.isnan(au).any():
+            s_d = np.minimum(s_d, sm, out=s_d)
+
+        else:
+            smmf = smm * (1 - (1 - fr_d) ** inv_ex)
+            smf = smmf / one_pex
+            ss_d = np.minimum(ss_d, smf, out=ss_d)
+            au = smmf * (1 - (1 - ss_d / smf) ** inv_1pex)
+            if np.isnan(au[active]).any():
                 raise ValueError(
                     "Error: NaN values detected. Try set clip function or check your data!!!"
                 )
@@ -582,29 +640,25 @@ def sources5mm(
                         - np.minimum(pen[fr_mask] + au[fr_mask], smmf[fr_mask])
                         / smmf[fr_mask]
                     )
-                    ** (ex[fr_mask] + 1)
+                    ** one_pex[fr_mask]
                 )
                 * fr_d[fr_mask],
                 (pen[fr_mask] + ss_d[fr_mask] - smf[fr_mask]) * fr_d[fr_mask],
             )
-            rs_j = np.minimum(rs_j, rn)
+            rs_j = np.minimum(rs_j, rn, out=rs_j)
             s_d[fr_mask] = ss_d[fr_mask] + (rn[fr_mask] - rs_j[fr_mask]) / fr_d[fr_mask]
-            s_d = np.minimum(s_d, smf)
+            s_d = np.minimum(s_d, smf, out=s_d)
 
-        else:
-            raise NotImplementedError(
-                "We don't have this implementation! Please chose 'HF' or 'EH'!!"
-            )
         rss_j = s_d * kss_d * fr_d
         rg_j = s_d * kg_d * fr_d
         s1_d = s_d * (1 - kss_d - kg_d)
 
-        rs = rs + rs_j
-        rss = rss + rss_j
-        rg = rg + rg_j
+        rs = rs + np.where(active, rs_j, 0.0)
+        rss = rss + np.where(active, rss_j, 0.0)
+        rg = rg + np.where(active, rg_j, 0.0)
         # Assign s_d and fr_d to the arrays as initial values for the next segment
-        s_ds.append(s1_d)
-        fr_ds.append(fr_d)
+        s_ds.append(np.where(active, s1_d, s0_d))
+        fr_ds.append(np.where(active, fr_d, fr0_d))
 
     return (rs, rss, rg), (s_ds[-1], fr_ds[-1])
 
@@ -635,6 +689,31 @@ def linear_reservoir(x, weight, last_y=None) -> np.array:
     return weight * last_y + weight1 * x
 
 
+def linear_reservoir_series(x, weight, last_y) -> np.array:
+    """
+    Linear reservoir's release for all periods; same as calling linear_reservoir period by period
+
+    The weights differ between basins, so the recursion runs in the linear_reservoir_route kernel.
+
+    Parameters
+    ----------
+    x
+        the input to the linear reservoir; dim: [time, basin]
+    weight
+        the coefficient of linear reservoir; dim: [basin]
+    last_y
+        the output of the period before the first one; dim: [basin]
+
+    Returns
+    -------
+    np.array
+        the output for all periods; dim: [time, basin]
+    """
+    y = np.empty(x.shape, dtype=x.dtype)
+    linear_reservoir_route(x, weight, last_y, y, basin_block(x.shape[1]))
+    return y
+
+
 def uh_conv(x, uh_from_gamma):
     """
     Function for 1d-convolution calculation
@@ -657,10 +736,18 @@ def uh_conv(x, uh_from_gamma):
     time_length, batch_size, feature_size = x.shape
     if feature_size > 1:
         logging.error("We only support one-dim convolution now!!!")
+    # the convolution runs along time, so time is made the innermost (contiguous) axis once: [batch, seq]
+    inputs = np.ascontiguousarray(x[:, :, 0].T)
+    uhs = np.ascontiguousarray(uh_from_gamma[:, :, 0].T)
+    if uhs.shape[1] >= 128:
+        # direct convolution costs O(time * len_uh) for each basin, so FFT is faster for a long unit hydrograph;
+        # all basins are convolved at once along the time axis
+        outputs[:, :, 0] = signal.fftconvolve(inputs, uhs, axes=1)[:, :time_length].T
+        return outputs
+    convs = np.empty(inputs.shape)
     for i in range(batch_size):
-        uh = uh_from_gamma[:, i, 0]
-        inputs = x[:, i, 0]
-        outputs[:, i, 0] = np.convolve(inputs, uh)[:time_length]
+        convs[i] = np.convolve(inputs[i], uhs[i])[:time_length]
+    outputs[:, :, 0] = convs.T
     return outputs
 
 
@@ -689,9 +776,11 @@ def uh_gamma(a, theta, len_uh=15):
             "length of unit hydrograph should be smaller than the whole length of input"
         )
     # aa > 0, here we set minimum 0.1 (min of a is 0, set when calling this func); First dimension of a is repeat
-    aa = np.maximum(0.0, a[0:len_uh, :, :]) + 0.1
+    aa = np.maximum(0.0, a[0:len_uh, :, :])
+    aa += 0.1
     # theta > 0, here set minimum 0.5
-    theta = np.maximum(0.0, theta[0:len_uh, :, :]) + 0.5
+    theta = np.maximum(0.0, theta[0:len_uh, :, :])
+    theta += 0.5
     # len_f, batch, feature
     t = np.expand_dims(
         np.swapaxes(np.tile(np.arange(0.5, len_uh * 1.0), (m[1], 1)), 0, 1), axis=-1
@@ -742,18 +831,30 @@ def xaj(
         time_interval_hours:
             the time interval of the model, default is 1 hour, for daily case, it should be 24
             this is only used when source_type is "sources5mm"
+        dtype:
+            the float type used for the calculation, default is np.float64;
+            np.float32 halves the memory traffic, and the outputs are also np.float32 in this case
+        num_threads:
+            number of threads used by the numba kernels which run basins in parallel;
+            default is None, i.e. numba's setting (all cores unless NUMBA_NUM_THREADS is set);
+            set it to 1 when many models are run in parallel processes
 
     Returns
     -------
     Union[np.array, tuple]
         streamflow or (streamflow, states)
     """
+    num_threads = kwargs.pop("num_threads", None)
+    if num_threads is not None:
+        with numba_threads(num_threads):
+            return xaj(p_and_e, params, return_state, warmup_length, **kwargs)
     # default values for some function parameters
     model_name = kwargs.get("name", "xaj")
     source_type = kwargs.get("source_type", "sources")
     source_book = kwargs.get("source_book", "HF")
     kernel_size = kwargs.get("kernel_size", 15)
     time_interval_hours = kwargs.get("time_interval_hours", 24)
+    dtype = kwargs.get("dtype", np.float64)
     model_param_dict = kwargs.get(f"{model_name}", None)
     if model_param_dict is None:
         model_param_dict = MODEL_PARAM_DICT[f"{model_name}"]
@@ -771,6 +872,9 @@ def xaj(
         raise ValueError(
             "Parameters contain NaN values. Please check your opt algorithm"
         )
+    # all parameters, states and fluxes are calculated in the float type given by dtype
+    p_and_e = np.asarray(p_and_e, dtype=dtype)
+    params = np.asarray(params, dtype=dtype)
     # xaj_params = [
     #     (value[1] - value[0]) * params[:, i] + value[0]
     #     for i, (key, value) in enumerate(param_ranges.items())
@@ -825,7 +929,7 @@ def xaj(
     # initialize state values
     if warmup_length > 0:
         p_and_e_warmup = p_and_e[0:warmup_length, :, :]
-        _q, _e, *w0, s0, fr0, qi0, qg0 = xaj(
+        _q, _e, *states0 = xaj(
             p_and_e_warmup,
             params,
             return_state=True,
@@ -833,116 +937,143 @@ def xaj(
             **kwargs,
         )
     else:
-        w0 = (0.5 * um, 0.5 * lm, 0.5 * dm)
-        s0 = 0.5 * sm
-        fr0 = np.full(ex.shape, 0.1)
-        qi0 = np.full(ci.shape, 0.1)
-        qg0 = np.full(cg.shape, 0.1)
+        states0 = [
+            0.5 * um,
+            0.5 * lm,
+            0.5 * dm,
+            0.5 * sm,
+            np.full(ex.shape, 0.1),
+            np.full(ci.shape, 0.1),
+            np.full(cg.shape, 0.1),
+        ]
+    # all state variables of a basin are kept in one row of a C-order array: [basin, state];
+    # the columns are WU, WL, WD, S, FR, QI, QG; the kernels update it in place
+    states = np.ascontiguousarray(np.stack(states0, axis=1), dtype=dtype)
 
     # state_variables
     inputs = p_and_e[warmup_length:, :, :]
-    runoff_ims_ = np.full(inputs.shape[:2], 0.0)
-    rss_ = np.full(inputs.shape[:2], 0.0)
-    ris_ = np.full(inputs.shape[:2], 0.0)
-    rgs_ = np.full(inputs.shape[:2], 0.0)
-    es_ = np.full(inputs.shape[:2], 0.0)
-    for i in range(inputs.shape[0]):
-        if i == 0:
-            (r, rim, e, pe), w = generation(
-                inputs[i, :, :], k, b, im, um, lm, dm, c, *w0
-            )
-            if source_type == "sources":
-                (rs, ri, rg), (s, fr) = sources(
-                    pe, r, sm, ex, ki, kg, s0, fr0, book=source_book
-                )
-            elif source_type == "sources5mm":
-                (rs, ri, rg), (s, fr) = sources5mm(
-                    pe,
-                    r,
-                    sm,
-                    ex,
-                    ki,
-                    kg,
-                    s0,
-                    fr0,
-                    time_interval_hours=time_interval_hours,
-                    book=source_book,
-                )
-            else:
-                raise NotImplementedError("No such divide-sources method")
-        else:
-            (r, rim, e, pe), w = generation(
-                inputs[i, :, :], k, b, im, um, lm, dm, c, *w
+    # make sure physical variables' value ranges are correct; done for all periods at once
+    prcp = np.maximum(inputs[:, :, 0], 0.0)
+    # get potential evapotranspiration
+    pet = inputs[:, :, 1] * k
+    np.maximum(pet, 0.0, out=pet)
+    # all periods of the outputs are written in place, so they don't need to be initialized
+    runoff_ims_ = np.empty(inputs.shape[:2], dtype=dtype)
+    rss_ = np.empty(inputs.shape[:2], dtype=dtype)
+    ris_ = np.empty(inputs.shape[:2], dtype=dtype)
+    rgs_ = np.empty(inputs.shape[:2], dtype=dtype)
+    es_ = np.empty(inputs.shape[:2], dtype=dtype)
+    err = np.zeros(inputs.shape[1], dtype=np.int8)
+    # the values derived from parameters are calculated once rather than in every period
+    # KI and KG of the time interval divide by KI, so they are only derived for sources5mm
+    period_num_1d = (
+        period_num_per_day(time_interval_hours) if source_type == "sources5mm" else None
+    )
+    consts = xaj_constants(b, um, lm, dm, sm, ex, ki, kg, period_num_1d)
+    block = basin_block(inputs.shape[1])
+    if source_type == "sources":
+        if source_book not in ["HF", "EH"]:
+            raise ValueError("Please set book as 'HF' or 'EH'!")
+        xaj_core(
+            prcp,
+            pet,
+            consts,
+            im,
+            um,
+            lm,
+            dm,
+            c,
+            sm,
+            ki,
+            kg,
+            source_book == "HF",
+            states,
+            runoff_ims_,
+            rss_,
+            ris_,
+            rgs_,
+            es_,
+            err,
+            block,
+        )
+        raise_kernel_error(err)
+    elif source_type == "sources5mm":
+        # runoff generation doesn't depend on the sources division,
+        # so all periods are generated first and only sources5mm is called step by step
+        runoffs_ = np.empty(inputs.shape[:2], dtype=dtype)
+        pes_ = np.empty(inputs.shape[:2], dtype=dtype)
+        generation_core(
+            prcp,
+            pet,
+            consts,
+            im,
+            um,
+            lm,
+            dm,
+            c,
+            states,
+            runoffs_,
+            runoff_ims_,
+            es_,
+            pes_,
+            err,
+            block,
+        )
+        raise_kernel_error(err)
+        if source_book not in ["HF", "EH"]:
+            raise NotImplementedError(
+                "We don't have this implementation! Please chose 'HF' or 'EH'!!"
             )
-            if source_type == "sources":
-                (rs, ri, rg), (s, fr) = sources(
-                    pe, r, sm, ex, ki, kg, s, fr, book=source_book
-                )
-            elif source_type == "sources5mm":
-                (rs, ri, rg), (s, fr) = sources5mm(
-                    pe,
-                    r,
-                    sm,
-                    ex,
-                    ki,
-                    kg,
-                    s,
-                    fr,
-                    time_interval_hours=time_interval_hours,
-                    book=source_book,
-                )
-            else:
-                raise NotImplementedError("No such divide-sources method")
-        # impevious part is pe * im
-        runoff_ims_[i, :] = rim
-        # so for non-imprvious part, the result should be corrected
-        rss_[i, :] = rs * (1 - im)
-        ris_[i, :] = ri * (1 - im)
-        rgs_[i, :] = rg * (1 - im)
-        es_[i, :] = e
-    # seq, batch, feature
-    runoff_im = np.expand_dims(runoff_ims_, axis=2)
-    rss = np.expand_dims(rss_, axis=2)
-    es = np.expand_dims(es_, axis=2)
-
-    qs = np.full(inputs.shape[:2], 0.0)
+        # divide the runoff of each basin to some <5mm pieces
+        sources5mm_core(
+            pes_,
+            runoffs_,
+            num_5mm_pieces(runoffs_),
+            consts,
+            im,
+            sm,
+            source_book == "HF",
+            states,
+            rss_,
+            ris_,
+            rgs_,
+            err,
+            block,
+        )
+        raise_kernel_error(err)
+    else:
+        raise NotImplementedError("No such divide-sources method")
+    qs = np.empty(inputs.shape[:2], dtype=dtype)
+    # interflow and groundwater are routed by linear reservoirs
+    qi = linear_reservoir_series(ris_, ci, states[:, QI])
+    qg = linear_reservoir_series(rgs_, cg, states[:, QG])
     if route_method == "CSL":
-        qt = np.full(inputs.shape[:2], 0.0)
-        for i in range(inputs.shape[0]):
-            if i == 0:
-                qi = linear_reservoir(ris_[i], ci, qi0)
-                qg = linear_reservoir(rgs_[i], cg, qg0)
-            else:
-                qi = linear_reservoir(ris_[i], ci, qi)
-                qg = linear_reservoir(rgs_[i], cg, qg)
-            qs_ = rss_[i]
-            qt[i, :] = qs_ + qi + qg
-        for j in range(len(l)):
-            lag = int(l[j])
-            for i in range(lag):
-                qs[i, j] = qt[i, j]
-            for i in range(lag, inputs.shape[0]):
-                qs[i, j] = cs[j] * qs[i - 1, j] + (1 - cs[j]) * qt[i - lag, j]
+        qt = rss_ + qi
+        qt += qg
+        csl_route(qt, cs, l.astype(int), qs)
     elif route_method == "MZ":
-        rout_a = a.repeat(rss.shape[0]).reshape(rss.shape)
-        rout_b = theta.repeat(rss.shape[0]).reshape(rss.shape)
+        # the routing parameters are same for all periods, so views are used for the time axis: [seq, batch, feature]
+        seq_shape = (inputs.shape[0], inputs.shape[1], 1)
+        rout_a = np.broadcast_to(a[:, None], seq_shape)
+        rout_b = np.broadcast_to(theta[:, None], seq_shape)
         conv_uh = uh_gamma(rout_a, rout_b, kernel_size)
-        qs_ = uh_conv(runoff_im + rss, conv_uh)
-        for i in range(inputs.shape[0]):
-            if i == 0:
-                qi = linear_reservoir(ris_[i], ci, qi0)
-                qg = linear_reservoir(rgs_[i], cg, qg0)
-            else:
-                qi = linear_reservoir(ris_[i], ci, qi)
-                qg = linear_reservoir(rgs_[i], cg, qg)
-            qs[i, :] = qs_[i, :, 0] + qi + qg
+        runoff_im_rss = runoff_ims_ + rss_
+        qs_ = uh_conv(runoff_im_rss[:, :, None], conv_uh)
+        np.add(qs_[:, :, 0], qi, out=qs)
+        qs += qg
     else:
         raise NotImplementedError(
             "We don't provide this route method now! Please use 'CS' or 'MZ'!"
         )
 
-    # seq, batch, feature
+    if inputs.shape[0] > 0:
+        states[:, QI] = qi[-1]
+        states[:, QG] = qg[-1]
+
+    # seq, batch, feature; the trailing axis is only added for the outputs
     q_sim = np.expand_dims(qs, axis=2)
+    es = np.expand_dims(es_, axis=2)
     if return_state:
-        return q_sim, es, *w, s, fr, qi, qg
+        # wu, wl, wd, s, fr, qi, qg
+        return q_sim, es, *states.T
     return q_sim, es
@@ -0,0 +1,773 @@
+"""
+Numba kernels for the XinAnJiang model.
+
+The functions in xaj.py work on whole arrays of basins for one time step, so a
+simulation pays Python and NumPy dispatch overhead (and many small temporary
+arrays) for every period. Here the same equations are written with scalar
+variables and the time loop is moved inside a compiled kernel; each basin is
+handled independently so the basin loop can run in parallel.
+
+Errors can not be raised inside a parallel loop, hence the kernels record an
+error code for each basin and the caller raises with ``raise_kernel_error``.
+Division by zero gives inf/NaN as in NumPy (error_model="numpy") rather than an exception.
+
+The kernels are compiled when they are called for the first time and the machine code is saved
+in numba's cache (cache=True), so only the first run after installation pays the compilation;
+call ``compile_kernels`` to pay it in advance, e.g. when building an image:
+``python -c "from hydromodel.models.xaj_numba import compile_kernels; compile_kernels()"``
+"""
+
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import numba
+import numpy as np
+from numba import jit, prange
+
+# column indices of the state variables in the array of states: [basin, state]
+WU, WL, WD, S, FR, QI, QG = range(7)
+
+# maximum number of basins handled together in the time loop of a kernel; see basin_block
+BASIN_BLOCK = 1024
+
+# error codes written by the kernels; 0 means no error
+NO_ERROR = 0
+ERR_W0_WM = 1
+ERR_FR_ZERO = 2
+ERR_PE_ZERO = 3
+ERR_AU_NAN = 4
+ERR_S_NAN = 5
+
+KERNEL_ERRORS = {
+    ERR_W0_WM: (ArithmeticError, "Please check if w0>wm or b is a negative value!"),
+    ERR_FR_ZERO: (
+        ArithmeticError,
+        "Please check fr's value, fr==0.0 will cause error in the next step!",
+    ),
+    ERR_PE_ZERO: (ArithmeticError, "Please check pe's data! there may be 0.0"),
+    ERR_AU_NAN: (
+        ValueError,
+        "Error: NaN values detected. Try set clip function or check your data!!!",
+    ),
+    ERR_S_NAN: (ArithmeticError, "Please check fr's data! there may be 0.0"),
+}
+
+
+def raise_kernel_error(err):
+    """
+    Raise the error recorded by a kernel, if there is one
+
+    Parameters
+    ----------
+    err
+        error codes of all basins, dim: [basin]
+    """
+    codes = err[err != NO_ERROR]
+    if codes.size > 0:
+        error_type, message = KERNEL_ERRORS[int(codes[0])]
+        raise error_type(message)
+
+
+class XajConstants(NamedTuple):
+    """
+    Values derived from the parameters of XAJ which don't change in the time loop; all fields have dim [basin]
+    """
+
+    one_pb: np.ndarray
+    """1 + B"""
+    inv_1pb: np.ndarray
+    """1 / (1 + B)"""
+    wm: np.ndarray
+    """tension water capacity: UM + LM + DM"""
+    wmm: np.ndarray
+    """maximum tension water capacity at a point: WM * (1 + B)"""
+    one_pex: np.ndarray
+    """1 + EX"""
+    inv_1pex: np.ndarray
+    """1 / (1 + EX)"""
+    inv_ex: np.ndarray
+    """1 / EX"""
+    ms: np.ndarray
+    """maximum free water capacity at a point: SM * (1 + EX)"""
+    kss_period: np.ndarray
+    """KI converted from 24 hours to the time interval (used in sources5mm; 0 when not needed)"""
+    kg_period: np.ndarray
+    """KG converted from 24 hours to the time interval (used in sources5mm; 0 when not needed)"""
+
+
+def xaj_constants(b, um, lm, dm, sm, ex, ki, kg, period_num_1d=None) -> XajConstants:
+    """
+    Calculate the constants used by the kernels once for a simulation
+
+    Parameters
+    ----------
+    b, um, lm, dm, sm, ex, ki, kg
+        parameters of XAJ; dim: [basin]
+    period_num_1d
+        number of periods in one day; only sources5mm needs KI and KG of the time interval,
+        so they are set to 0 when it is None, which avoids dividing by KI when KI is 0
+
+    Returns
+    -------
+    XajConstants
+        the constants of all basins
+    """
+    one_pb = 1.0 + b
+    wm = um + lm + dm
+    one_pex = 1.0 + ex
+    if period_num_1d is None:
+        kss_period = np.zeros_like(ki)
+        kg_period = np.zeros_like(kg)
+    else:
+        kss_period = (1 - (1 - (ki + kg)) ** (1 / period_num_1d)) / (1 + kg / ki)
+        kg_period = kss_period * kg / ki
+    return XajConstants(
+        one_pb=one_pb,
+        inv_1pb=1.0 / one_pb,
+        wm=wm,
+        wmm=wm * one_pb,
+        one_pex=one_pex,
+        inv_1pex=1.0 / one_pex,
+        inv_ex=1.0 / ex,
+        ms=sm * one_pex,
+        kss_period=kss_period,
+        kg_period=kg_period,
+    )
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def evap_step(lm, c, wu0, wl0, prcp, pet):
+    """Scalar version of calculate_evap in xaj.py"""
+    eu = min(wu0 + prcp, pet)
+    pet_left = pet - eu
+    if wl0 >= c * lm:
+        ed = 0.0
+        el = pet_left * wl0 / lm
+    else:
+        ed = max(c * pet_left - wl0, 0.0)
+        el = min(wl0, c * pet_left)
+    return eu, el, ed
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def prcp_runoff_step(one_pb, inv_1pb, im, wm, wmm, w0, pe):
+    """
+    Scalar version of calculate_prcp_runoff in xaj.py; a is returned for NaN check
+
+    one_pb, inv_1pb and wmm are 1 + b, 1 / (1 + b) and wm * (1 + b), respectively.
+    """
+    a = wmm * (1.0 - (1.0 - w0 / wm) ** inv_1pb)
+    if pe > 0.0:
+        if pe + a < wmm:
+            r_cal = pe - (wm - w0) + wm * (1.0 - min(a + pe, wmm) / wmm) ** one_pb
+        else:
+            r_cal = pe - (wm - w0)
+    else:
+        r_cal = 0.0
+    r = max(r_cal, 0.0)
+    r_im = max(pe * im, 0.0)
+    return r, r_im, a
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def w_storage_step(um, lm, dm, wu0, wl0, wd0, el, ed, pe, r):
+    """Scalar version of calculate_w_storage in xaj.py"""
+    if pe > 0.0:
+        wu = min(wu0 + pe - r, um)
+        wd = max(wu0 + wl0 + wd0 + pe - r - um - lm, wd0)
+        wl = wu0 + wl0 + wd0 + pe - r - wu - wd
+    else:
+        wu = max(wu0 + pe, 0.0)
+        wd = wd0 - ed
+        wl = wl0 - el
+    wu = min(max(wu, 0.0), um)
+    wl = min(max(wl, 0.0), lm)
+    wd = min(max(wd, 0.0), dm)
+    return wu, wl, wd
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def generation_step(
+    prcp, pet, one_pb, inv_1pb, wm, wmm, im, um, lm, dm, c, wu0, wl0, wd0
+):
+    """
+    Scalar version of generation in xaj.py
+
+    prcp and pet should have been limited to non-negative values (and pet multiplied by k);
+    one_pb, inv_1pb, wm and wmm are the constants in XajConstants. The last returned value is an error code.
+    """
+    w0 = min(wu0 + wl0 + wd0, wm - 1e-5)
+    eu, el, ed = evap_step(lm, c, wu0, wl0, prcp, pet)
+    e = eu + el + ed
+    prcp_difference = prcp - e
+    pe = max(prcp_difference, 0.0)
+    r, rim, a = prcp_runoff_step(one_pb, inv_1pb, im, wm, wmm, w0, pe)
+    if np.isnan(a):
+        return r, rim, e, pe, wu0, wl0, wd0, ERR_W0_WM
+    wu, wl, wd = w_storage_step(um, lm, dm, wu0, wl0, wd0, el, ed, prcp_difference, r)
+    return r, rim, e, pe, wu, wl, wd, NO_ERROR
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def sources_step(pe, r, sm, ms, one_pex, inv_1pex, inv_ex, ki, kg, s0, fr0, hf):
+    """
+    Scalar version of sources in xaj.py
+
+    ms, one_pex, inv_1pex and inv_ex are sm * (1 + ex), 1 + ex, 1 / (1 + ex) and 1 / ex, respectively.
+    hf is True for the method in "Hydrologic Forecasting" (book="HF"),
+    otherwise the one in "Engineering Hydrology" (book="EH") is used.
+    The last returned value is an error code.
+    """
+    if fr0 == 0.0:
+        return 0.0, 0.0, 0.0, s0, fr0, ERR_FR_ZERO
+    fr = fr0
+    ss = s0
+    s = s0
+    if r > 0.0:
+        fr = r / pe
+        if np.isnan(fr):
+            return 0.0, 0.0, 0.0, s0, fr0, ERR_PE_ZERO
+        ss = fr0 * s0 / fr
+    rs = 0.0
+    if hf:
+        if ss > sm:
+            ss = sm
+        au = ms * (1.0 - (1.0 - ss / sm) ** inv_1pex)
+        if np.isnan(au):
+            return 0.0, 0.0, 0.0, s0, fr0, ERR_AU_NAN
+        if r > 0.0:
+            if pe + au < ms:
+                rs = fr * (pe - sm + ss + sm * (1.0 - min(pe + au, ms) / ms) ** one_pex)
+            else:
+                rs = fr * (pe + ss - sm)
+            rs = min(rs, r)
+            s = ss + (r - rs) / fr
+        if s > sm:
+            s = sm
+        if np.isnan(s):
+            return 0.0, 0.0, 0.0, s0, fr0, ERR_S_NAN
+    else:
+        smmf = ms * (1 - (1.0 - fr) ** inv_ex)
+        smf = smmf / one_pex
+        if ss > smf:
+            ss = smf
+        au = smmf * (1 - (1.0 - ss / smf) ** inv_1pex)
+        if np.isnan(au):
+            return 0.0, 0.0, 0.0, s0, fr0, ERR_AU_NAN
+        if r > 0.0:
+            if pe + au < smmf:
+                rs = (
+                    pe - smf + ss + smf * (1.0 - min(pe + au, smmf) / smmf) ** one_pex
+                ) * fr
+            else:
+                rs = (pe + ss - smf) * fr
+            rs = min(rs, r)
+            s = ss + (r - rs) / fr
+        if s > smf:
+            s = smf
+    ri = ki * s * fr
+    rg = kg * s * fr
+    s1 = s * (1 - ki - kg)
+    return rs, ri, rg, s1, fr, NO_ERROR
+
+
+@contextmanager
+def numba_threads(num_threads):
+    """
+    Run the kernels with the given number of threads, and restore the former number when finished
+
+    Parameters
+    ----------
+    num_threads
+        number of threads; it can't be larger than numba.config.NUMBA_NUM_THREADS
+    """
+    former = numba.get_num_threads()
+    numba.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        numba.set_num_threads(former)
+
+
+def basin_block(n_basin):
+    """
+    Number of basins which a kernel handles together in its time loop
+
+    The arrays are sequence-first ([time, basin]), so a kernel walking down the time axis for one basin
+    only uses 8 bytes of every cache line it loads; handling a block of neighbouring basins in each period
+    reads contiguous memory and keeps the block's states in cache. Blocks are also the unit of parallel work,
+    so they are not larger than needed to give every thread one block.
+
+    Parameters
+    ----------
+    n_basin
+        number of basins
+
+    Returns
+    -------
+    int
+        number of basins in a block
+    """
+    n_threads = numba.get_num_threads()
+    return max(1, min(BASIN_BLOCK, -(-n_basin // n_threads)))
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def generation_core(
+    prcp, pet, consts, im, um, lm, dm, c, states, r, rim, e, pe, err, block
+):
+    """
+    Runoff generation of XAJ for all periods and basins
+
+    Only the soil moisture of the three layers is carried from one period to the next;
+    the initial values in the WU/WL/WD columns of states are updated in place to their final values.
+
+    Parameters
+    ----------
+    prcp, pet
+        non-negative precipitation and potential evapotranspiration; dim: [time, basin]
+    consts
+        XajConstants of all basins
+    im, um, lm, dm, c
+        parameters of XAJ; dim: [basin]
+    states
+        state variables; dim: [basin, state]
+    r, rim, e, pe
+        outputs (see generation in xaj.py); dim: [time, basin]
+    err
+        error code of each basin; dim: [basin]
+    block
+        number of basins handled together in the time loop; see basin_block
+    """
+    n_time, n_basin = prcp.shape
+    for k in prange(-(-n_basin // block)):
+        j0 = k * block
+        j1 = min(j0 + block, n_basin)
+        states_ = states[j0:j1].copy()
+        for i in range(n_time):
+            for j in range(j0, j1):
+                if err[j] != NO_ERROR:
+                    continue
+                jj = j - j0
+                r_, rim_, e_, pe_, wu_, wl_, wd_, code = generation_step(
+                    prcp[i, j],
+                    pet[i, j],
+                    consts.one_pb[j],
+                    consts.inv_1pb[j],
+                    consts.wm[j],
+                    consts.wmm[j],
+                    im[j],
+                    um[j],
+                    lm[j],
+                    dm[j],
+                    c[j],
+                    states_[jj, WU],
+                    states_[jj, WL],
+                    states_[jj, WD],
+                )
+                if code != NO_ERROR:
+                    err[j] = code
+                    continue
+                states_[jj, WU], states_[jj, WL], states_[jj, WD] = wu_, wl_, wd_
+                r[i, j] = r_
+                rim[i, j] = rim_
+                e[i, j] = e_
+                pe[i, j] = pe_
+        states[j0:j1] = states_
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def xaj_core(
+    prcp,
+    pet,
+    consts,
+    im,
+    um,
+    lm,
+    dm,
+    c,
+    sm,
+    ki,
+    kg,
+    hf,
+    states,
+    runoff_im,
+    rss,
+    ris,
+    rgs,
+    es,
+    err,
+    block,
+):
+    """
+    Runoff generation and sources division of XAJ for all periods and basins
+
+    The initial values in the WU/WL/WD/S/FR columns of states are updated in place to their final values;
+    runoff_im/rss/ris/rgs/es are the outputs with dim [time, basin]; rss/ris/rgs
+    have been multiplied by (1 - im), i.e. they are runoff from the pervious part.
+
+    Parameters
+    ----------
+    prcp, pet
+        non-negative precipitation and potential evapotranspiration; dim: [time, basin]
+    consts
+        XajConstants of all basins
+    im, um, lm, dm, c, sm, ki, kg
+        parameters of XAJ; dim: [basin]
+    hf
+        True for book="HF" and False for book="EH" in sources
+    states
+        state variables; dim: [basin, state]
+    runoff_im, rss, ris, rgs, es
+        outputs; dim: [time, basin]
+    err
+        error code of each basin; dim: [basin]
+    block
+        number of basins handled together in the time loop; see basin_block
+    """
+    n_time, n_basin = prcp.shape
+    for k in prange(-(-n_basin // block)):
+        j0 = k * block
+        j1 = min(j0 + block, n_basin)
+        states_ = states[j0:j1].copy()
+        for i in range(n_time):
+            for j in range(j0, j1):
+                if err[j] != NO_ERROR:
+                    continue
+                jj = j - j0
+                r, rim, e, pe, wu_, wl_, wd_, code = generation_step(
+                    prcp[i, j],
+                    pet[i, j],
+                    consts.one_pb[j],
+                    consts.inv_1pb[j],
+                    consts.wm[j],
+                    consts.wmm[j],
+                    im[j],
+                    um[j],
+                    lm[j],
+                    dm[j],
+                    c[j],
+                    states_[jj, WU],
+                    states_[jj, WL],
+                    states_[jj, WD],
+                )
+                if code != NO_ERROR:
+                    err[j] = code
+                    continue
+                rs, ri, rg, s_, fr_, code = sources_step(
+                    pe,
+                    r,
+                    sm[j],
+                    consts.ms[j],
+                    consts.one_pex[j],
+                    consts.inv_1pex[j],
+                    consts.inv_ex[j],
+                    ki[j],
+                    kg[j],
+                    states_[jj, S],
+                    states_[jj, FR],
+                    hf,
+                )
+                if code != NO_ERROR:
+                    err[j] = code
+                    continue
+                states_[jj, WU], states_[jj, WL], states_[jj, WD] = wu_, wl_, wd_
+                states_[jj, S], states_[jj, FR] = s_, fr_
+                runoff_im[i, j] = rim
+                rss[i, j] = rs * (1 - im[j])
+                ris[i, j] = ri * (1 - im[j])
+                rgs[i, j] = rg * (1 - im[j])
+                es[i, j] = e
+        states[j0:j1] = states_
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def sources5mm_hf_piece(pen, rn, sm, smm, one_pex, inv_1pex, s0_d, fr0_d, fr_d):
+    """
+    One 5mm piece of sources5mm in xaj.py for the method in "Hydrologic Forecasting" (book="HF")
+
+    Returns rs of the piece, free water storage s_d before releasing interflow and groundwater,
+    and an error code.
+    """
+    ss_d = s0_d
+    s_d = s0_d
+    if rn > 0.0:
+        ss_d = fr0_d * s0_d / fr_d
+    if ss_d > sm:
+        ss_d = sm
+    au = smm * (1.0 - (1.0 - ss_d / sm) ** inv_1pex)
+    if np.isnan(au):
+        return 0.0, s_d, ERR_AU_NAN
+    rs_j = 0.0
+    if rn > 0.0:
+        if pen + au < smm:
+            # equation 5-26 in HF
+            rs_j = fr_d * (
+                pen - sm + ss_d + sm * (1 - min(pen + au, smm) / smm) ** one_pex
+            )
+        else:
+            # equation 5-27 in HF
+            rs_j = fr_d * (pen + ss_d - sm)
+        rs_j = min(rs_j, rn)
+        s_d = ss_d + (rn - rs_j) / fr_d
+    if s_d > sm:
+        s_d = sm
+    return rs_j, s_d, NO_ERROR
+
+
+@jit(nopython=True, error_model="numpy", cache=True)
+def sources5mm_eh_piece(pen, rn, sm, smm, one_pex, inv_1pex, inv_ex, s0_d, fr0_d, fr_d):
+    """
+    One 5mm piece of sources5mm in xaj.py for the method in "Engineering Hydrology" (book="EH")
+
+    Returns rs of the piece, free water storage s_d before releasing interflow and groundwater,
+    and an error code.
+    """
+    ss_d = s0_d
+    s_d = s0_d
+    if rn > 0.0:
+        ss_d = fr0_d * s0_d / fr_d
+    smmf = smm * (1 - (1 - fr_d) ** inv_ex)
+    smf = smmf / one_pex
+    if ss_d > smf:
+        ss_d = smf
+    au = smmf * (1 - (1 - ss_d / smf) ** inv_1pex)
+    if np.isnan(au):
+        return 0.0, s_d, ERR_AU_NAN
+    rs_j = 0.0
+    if rn > 0.0:
+        if pen + au < smmf:
+            rs_j = (
+                pen - smf + ss_d + smf * (1 - min(pen + au, smmf) / smmf) ** one_pex
+            ) * fr_d
+        else:
+            rs_j = (pen + ss_d - smf) * fr_d
+        rs_j = min(rs_j, rn)
+        s_d = ss_d + (rn - rs_j) / fr_d
+    if s_d > smf:
+        s_d = smf
+    return rs_j, s_d, NO_ERROR
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def sources5mm_core(
+    pe, runoff, n, consts, im, sm, hf, states, rss, ris, rgs, err, block
+):
+    """
+    sources5mm in xaj.py for all periods and basins
+
+    The initial values in the S/FR columns of states are updated in place to their final values;
+    rss/ris/rgs are the outputs which have been multiplied by (1 - im).
+
+    Parameters
+    ----------
+    pe, runoff
+        net precipitation and runoff from generation_core; dim: [time, basin]
+    n
+        number of 5mm pieces of each period and basin; dim: [time, basin]
+    consts
+        XajConstants of all basins; kss_period and kg_period are Ki and Kg of the time interval
+    im, sm
+        parameters of XAJ; dim: [basin]
+    hf
+        True for book="HF" and False for book="EH"
+    states
+        state variables; dim: [basin, state]
+    rss, ris, rgs
+        outputs; dim: [time, basin]
+    err
+        error code of each basin; dim: [basin]
+    block
+        number of basins handled together in the time loop; see basin_block
+    """
+    n_time, n_basin = pe.shape
+    for k in prange(-(-n_basin // block)):
+        j0 = k * block
+        j1 = min(j0 + block, n_basin)
+        states_ = states[j0:j1].copy()
+        for i in range(n_time):
+            for j in range(j0, j1):
+                if err[j] != NO_ERROR:
+                    continue
+                jj = j - j0
+                s_, fr_ = states_[jj, S], states_[jj, FR]
+                kss_period, kg_period = consts.kss_period[j], consts.kg_period[j]
+                n_i = n[i, j]
+                fr = fr_
+                if runoff[i, j] > 0.0:
+                    fr = runoff[i, j] / pe[i, j]
+                rn = runoff[i, j] / n_i
+                pen = pe[i, j] / n_i
+                kss_d = (1 - (1 - (kss_period + kg_period)) ** (1 / n_i)) / (
+                    1 + kg_period / kss_period
+                )
+                kg_d = kss_d * kg_period / kss_period
+                rs = 0.0
+                ri = 0.0
+                rg = 0.0
+                code = NO_ERROR
+                for _ in range(n_i):
+                    if hf:
+                        rs_j, s_d, code = sources5mm_hf_piece(
+                            pen,
+                            rn,
+                            sm[j],
+                            consts.ms[j],
+                            consts.one_pex[j],
+                            consts.inv_1pex[j],
+                            s_,
+                            fr_,
+                            fr,
+                        )
+                    else:
+                        rs_j, s_d, code = sources5mm_eh_piece(
+                            pen,
+                            rn,
+                            sm[j],
+                            consts.ms[j],
+                            consts.one_pex[j],
+                            consts.inv_1pex[j],
+                            consts.inv_ex[j],
+                            s_,
+                            fr_,
+                            fr,
+                        )
+                    if code != NO_ERROR:
+                        break
+                    rs = rs + rs_j
+                    ri = ri + s_d * kss_d * fr
+                    rg = rg + s_d * kg_d * fr
+                    # initial values for the next piece
+                    s_ = s_d * (1 - kss_d - kg_d)
+                    fr_ = fr
+                if code != NO_ERROR:
+                    err[j] = code
+                    continue
+                states_[jj, S], states_[jj, FR] = s_, fr_
+                rss[i, j] = rs * (1 - im[j])
+                ris[i, j] = ri * (1 - im[j])
+                rgs[i, j] = rg * (1 - im[j])
+        states[j0:j1] = states_
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def linear_reservoir_route(x, weight, last_y, y, block):
+    """
+    Linear reservoir's release for all periods: y[t] = weight * y[t-1] + (1 - weight) * x[t]
+
+    Parameters
+    ----------
+    x
+        the input to the linear reservoir; dim: [time, basin]
+    weight
+        the coefficient of linear reservoir; dim: [basin]
+    last_y
+        the output of the period before the first one; dim: [basin]
+    y
+        output of all periods; dim: [time, basin]
+    block
+        number of basins handled together in the time loop; see basin_block
+    """
+    n_time, n_basin = x.shape
+    for k in prange(-(-n_basin // block)):
+        j0 = k * block
+        j1 = min(j0 + block, n_basin)
+        y_ = last_y[j0:j1].copy()
+        for i in range(n_time):
+            for j in range(j0, j1):
+                jj = j - j0
+                y_[jj] = weight[j] * y_[jj] + (1 - weight[j]) * x[i, j]
+                y[i, j] = y_[jj]
+
+
+@jit(nopython=True, parallel=True, error_model="numpy", cache=True)
+def csl_route(qt, cs, lag, qs):
+    """
+    Lag and recession routing of the channel system ("CSL" in xaj)
+
+    Parameters
+    ----------
+    qt
+        total inflow of the channel system; dim: [time, basin]
+    cs
+        recession constant of the channel system; dim: [basin]
+    lag
+        lag time (integer periods); dim: [basin]
+    qs
+        output streamflow; dim: [time, basin]
+    """
+    n_time = qt.shape[0]
+    for j in prange(qt.shape[1]):
+        lag_j = min(lag[j], n_time)
+        for i in range(lag_j):
+            qs[i, j] = qt[i, j]
+        for i in range(lag_j, n_time):
+            qs[i, j] = (1 - cs[j]) * qt[i - lag_j, j]
+            # the outflow before the first period is 0 when there is no lag
+            if i > 0:
+                qs[i, j] += cs[j] * qs[i - 1, j]
+
+
+def compile_kernels(dtypes=(np.float64, np.float32)):
+    """
+    Compile the kernels with the argument types used by xaj and save them to numba's cache
+
+    Parameters
+    ----------
+    dtypes
+        the float types which the kernels are compiled for
+    """
+    for dtype in dtypes:
+        one = np.ones(1, dtype=dtype)
+        series = np.ones((1, 1), dtype=dtype)
+        consts = xaj_constants(one, one, one, one, one, one, 0.5 * one, 0.25 * one)
+        # two basins, so that a column of states is strided as it is in xaj
+        states = np.full((2, 7), 0.5, dtype=dtype)
+        err = np.zeros(1, dtype=np.int8)
+        generation_core(
+            series,
+            series,
+            consts,
+            one,
+            one,
+            one,
+            one,
+            one,
+            states,
+            *(series.copy() for _ in range(4)),
+            err,
+            1,
+        )
+        xaj_core(
+            series,
+            series,
+            consts,
+            one,
+            one,
+            one,
+            one,
+            one,
+            one,
+            one,
+            one,
+            True,
+            states,
+            *(series.copy() for _ in range(5)),
+            err,
+            1,
+        )
+        sources5mm_core(
+            series,
+            series,
+            np.ones((1, 1), dtype=int),
+            consts,
+            one,
+            one,
+            True,
+            states,
+            *(series.copy() for _ in range(3)),
+            err,
+            1,
+        )
+        linear_reservoir_route(series, one, states[:, 0], series.copy(), 1)
+        csl_route(series, one, np.ones(1, dtype=int), series.copy())
@@ -11,7 +11,7 @@ Copyright (c) 2023-2024 Wenyu Ouyang. All rights reserved.
 import numpy as np
 import pytest
 
-from hydromodel.models.gr4j import gr4j
+from hydromodel.models.gr4j import gr4j, uh_gr4j
 
 
 @pytest.fixture()
@@ -25,3 +25,24 @@ def test_gr4j(p_and_e, params, qobs, warmup_length):
     np.testing.assert_array_equal(
         qsim.shape, (qobs.shape[0] - warmup_length, qobs.shape[1], qobs.shape[2])
     )
+
+
+def test_uh_gr4j():
+    uh1s, uh2s = uh_gr4j(np.array([0.5, 2.0, 3.7]))
+    assert [len(uh) for uh in uh1s] == [1, 2, 4]
+    assert [len(uh) for uh in uh2s] == [1, 4, 8]
+    np.testing.assert_allclose(uh1s[1], [0.5**2.5, 1 - 0.5**2.5])
+    np.testing.assert_allclose(
+        uh2s[1],
+        [0.5 * 0.5**2.5, 0.5 - 0.5 * 0.5**2.5, 0.5 - 0.5 * 0.5**2.5, 0.5 * 0.5**2.5],
+    )
+    for uh in uh1s + uh2s:
+        np.testing.assert_allclose(uh.sum(), 1.0)
+
+
+def test_uh_gr4j_cached():
+    uh1s, uh2s = uh_gr4j(np.array([2.0, 2.0]))
+    # the ordinates are computed once and shared by basins with same x4
+    assert uh1s[0] is uh1s[1]
+    assert uh2s[0] is uh2s[1]
+    assert not uh1s[0].flags.writeable
@@ -1,7 +1,24 @@
+import numba
 import numpy as np
 import pytest
 
-from hydromodel.models.xaj import xaj, uh_gamma, uh_conv
+from hydromodel.models.model_config import MODEL_PARAM_DICT
+from hydromodel.models.xaj import (
+    xaj,
+    uh_gamma,
+    uh_conv,
+    calculate_evap,
+    calculate_prcp_runoff,
+    calculate_w_storage,
+    generation,
+    sources,
+    sources5mm,
+    linear_reservoir,
+    linear_reservoir_series,
+)
+from hydromodel.models import xaj as xaj_module
+from hydromodel.models import xaj_numba
+from hydromodel.models.xaj_numba import evap_step
 
 
 @pytest.fixture()
@@ -10,6 +27,19 @@ def params():
     return np.tile([0.5], (1, 15))
 
 
+def synthetic_inputs(seed, n_time, n_basin):
+    """
+    Random forcings and normalized parameters so that the compiled kernels can be checked without datasets;
+    it doesn't rain in about half of the periods
+    """
+    rng = np.random.default_rng(seed)
+    prcp = rng.gamma(0.4, 12.0, size=(n_time, n_basin))
+    prcp[rng.random(prcp.shape) < 0.5] = 0.0
+    pet = 1.0 + 3.0 * rng.random(prcp.shape)
+    params = rng.uniform(0.05, 0.95, size=(n_basin, 15))
+    return np.stack([prcp, pet], axis=2), params
+
+
 def test_uh_gamma():
     # repeat for 20 periods and add one dim as feature: time_seq=20, batch=10, feature=1
     routa = np.tile(2.5, (20, 10, 1))
@@ -65,6 +95,116 @@ def test_uh():
     )
 
 
+def test_uh_conv_long_uh():
+    # a long unit hydrograph is convolved with FFT
+    rng = np.random.default_rng(0)
+    x = rng.random((500, 3, 1))
+    uh = rng.random((200, 3, 1))
+    uh = uh / uh.sum(axis=0)
+    qs = uh_conv(x, uh)
+    for i in range(3):
+        np.testing.assert_allclose(
+            qs[:, i, 0], np.convolve(x[:, i, 0], uh[:, i, 0])[:500], atol=1e-12
+        )
+
+
+def test_linear_reservoir_series():
+    rng = np.random.default_rng(0)
+    x = rng.random((50, 3))
+    weight = np.array([0.1, 0.5, 0.95])
+    y = np.full(3, 0.1)
+    ys = []
+    for i in range(x.shape[0]):
+        y = linear_reservoir(x[i], weight, y)
+        ys.append(y)
+    np.testing.assert_allclose(
+        linear_reservoir_series(x, weight, np.full(3, 0.1)), np.array(ys)
+    )
+
+
+@pytest.mark.parametrize("wl0_range", ["below_c_pet", "below_c_lm", "above_c_lm"])
+def test_calculate_evap_same_as_nested_where(wl0_range):
+    rng = np.random.default_rng(7)
+    lm, c = rng.uniform(60, 90, 100), rng.uniform(0.05, 0.2, 100)
+    wu0, prcp = rng.uniform(0, 20, 100), rng.uniform(0, 10, 100)
+    # half of the basins have enough water in upper layer
+    pet = np.where(rng.random(100) < 0.5, 0.5, 1.5) * (wu0 + prcp)
+    c_pet_left = c * np.maximum(pet - wu0 - prcp, 0.0)
+    low, high = {
+        "below_c_pet": (0.0, np.minimum(c_pet_left, c * lm)),
+        "below_c_lm": (np.minimum(c_pet_left, c * lm), c * lm),
+        "above_c_lm": (c * lm, lm),
+    }[wl0_range]
+    wl0 = low + (high - low) * rng.random(100)
+    # the nested where chains which calculate_evap was written with
+    eu = np.where(wu0 + prcp >= pet, pet, wu0 + prcp)
+    ed = np.where((wl0 < c * lm) & (wl0 < c * (pet - eu)), c * (pet - eu) - wl0, 0.0)
+    el = np.where(
+        wu0 + prcp >= pet,
+        0.0,
+        np.where(
+            wl0 >= c * lm,
+            (pet - eu) * wl0 / lm,
+            np.where(wl0 >= c * (pet - eu), c * (pet - eu), wl0),
+        ),
+    )
+    np.testing.assert_allclose(
+        calculate_evap(lm, c, wu0, wl0, prcp, pet), (eu, el, ed), rtol=1e-12
+    )
+    np.testing.assert_allclose(
+        np.array([evap_step(*args) for args in zip(lm, c, wu0, wl0, prcp, pet)]).T,
+        (eu, el, ed),
+        rtol=1e-12,
+    )
+
+
+def test_step_functions_scalar_inputs():
+    # the one-step functions are public, so numpy scalars should work as well as arrays
+    lm, c, wu0, wl0, prcp, pet = map(np.float64, (70.0, 0.1, 10.0, 20.0, 1.0, 13.0))
+    eu, el, ed = calculate_evap(lm, c, wu0, wl0, prcp, pet)
+    # the lower layer has enough water: el = (pet - eu) * wl0 / lm and ed = 0
+    np.testing.assert_allclose((eu, el, ed), (11.0, 2.0 * 20.0 / 70.0, 0.0))
+    evap_arrays = calculate_evap(*(np.array([x]) for x in (lm, c, wu0, wl0, prcp, pet)))
+    np.testing.assert_allclose((eu, el, ed), np.concatenate(evap_arrays))
+    b, im, wm, w0, pe = map(np.float64, (0.3, 0.01, 150.0, 90.0, 30.0))
+    r, r_im = calculate_prcp_runoff(b, im, wm, w0, pe)
+    runoff_arrays = calculate_prcp_runoff(*(np.array([x]) for x in (b, im, wm, w0, pe)))
+    np.testing.assert_allclose((r, r_im), np.concatenate(runoff_arrays))
+    um, dm, wd0 = map(np.float64, (20.0, 60.0, 50.0))
+    args = (um, lm, dm, wu0, wl0, wd0, eu, el, ed, pe, r)
+    np.testing.assert_allclose(
+        calculate_w_storage(*args),
+        np.concatenate(calculate_w_storage(*(np.array([x]) for x in args))),
+    )
+
+
+def test_step_functions_broadcast():
+    # the inputs of the one-step functions are broadcast against each other as numpy does
+    wl0 = np.array([[20.0], [5.0]])
+    evap_args = (70.0, 0.1, 10.0, wl0, np.array([1.0]), np.array([13.0]))
+    eu, el, ed = calculate_evap(*evap_args)
+    assert el.shape == ed.shape == (2, 1)
+    np.testing.assert_allclose(
+        np.broadcast_arrays(eu, el, ed),
+        calculate_evap(*np.broadcast_arrays(*evap_args)),
+    )
+    w0 = np.array([[90.0], [40.0]])
+    runoff_args = (0.3, 0.01, 150.0, w0, np.array([30.0, 2.0]))
+    r, r_im = calculate_prcp_runoff(*runoff_args)
+    assert r.shape == (2, 2)
+    np.testing.assert_allclose(
+        np.broadcast_arrays(r, r_im),
+        calculate_prcp_runoff(*np.broadcast_arrays(*runoff_args)),
+    )
+    dm = np.array([[60.0], [30.0]])
+    # dm has a larger shape than all the other inputs
+    storage_args = (20.0, 70.0, dm, 10.0, 20.0, 50.0, 1.0, 1.0, 0.0, 30.0, 25.0)
+    np.testing.assert_allclose(
+        np.broadcast_arrays(*calculate_w_storage(*storage_args)),
+        calculate_w_storage(*np.broadcast_arrays(*storage_args)),
+    )
+
+
 def test_xaj(p_and_e, params, warmup_length):
     qsim, e = xaj(
         p_and_e,
@@ -87,3 +227,169 @@ def test_xaj_mz(p_and_e, params, warmup_length):
         source_type="sources",
     )
     np.testing.assert_array_equal(qsim.shape[0], p_and_e.shape[0] - warmup_length)
+
+
+@pytest.mark.parametrize("source_type", ["sources", "sources5mm"])
+@pytest.mark.parametrize("source_book", ["HF", "EH"])
+def test_xaj_core_same_as_step_functions(source_book, source_type):
+    p_and_e, params = synthetic_inputs(42, 200, 4)
+    # keep ki + kg < 1 so that xaj doesn't rescale them
+    params[:, 9:11] *= 0.7
+    qsim, es, wu, wl, wd, s, fr, qi, qg = xaj(
+        p_and_e,
+        params,
+        return_state=True,
+        warmup_length=0,
+        name="xaj",
+        source_book=source_book,
+        source_type=source_type,
+    )
+    # the same runoff generation and sources division with the one-step functions
+    ranges = {
+        key: np.array(value)
+        for key, value in MODEL_PARAM_DICT["xaj"]["param_range"].items()
+    }
+    k, b, im, um, lm, dm, c, sm, ex, ki, kg, cs, l, ci, cg = (
+        ranges[key][0] + params[:, i] * (ranges[key][1] - ranges[key][0])
+        for i, key in enumerate(MODEL_PARAM_DICT["xaj"]["param_name"])
+    )
+    w = (0.5 * um, 0.5 * lm, 0.5 * dm)
+    s_, fr_ = 0.5 * sm, np.full(ex.shape, 0.1)
+    qi_, qg_ = np.full(ci.shape, 0.1), np.full(cg.shape, 0.1)
+    es_, qt = [], []
+    for i in range(p_and_e.shape[0]):
+        (r, rim, e, pe), w = generation(p_and_e[i], k, b, im, um, lm, dm, c, *w)
+        if source_type == "sources":
+            (rs, ri, rg), (s_, fr_) = sources(
+                pe, r, sm, ex, ki, kg, s_, fr_, book=source_book
+            )
+        else:
+            (rs, ri, rg), (s_, fr_) = sources5mm(
+                pe, r, sm, ex, ki, kg, s_, fr_, time_interval_hours=24, book=source_book
+            )
+        # the fluxes are corrected for the non-impervious part and routed as in CSL
+        qi_ = linear_reservoir(ri * (1 - im), ci, qi_)
+        qg_ = linear_reservoir(rg * (1 - im), cg, qg_)
+        qt.append(rs * (1 - im) + qi_ + qg_)
+        es_.append(e)
+    qt = np.array(qt)
+    qs = np.empty(qt.shape)
+    for j, lag in enumerate(l.astype(int)):
+        qs[:lag, j] = qt[:lag, j]
+        for i in range(lag, qt.shape[0]):
+            qs[i, j] = cs[j] * qs[i - 1, j] + (1 - cs[j]) * qt[i - lag, j]
+    np.testing.assert_allclose(es[:, :, 0], np.array(es_), rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(np.stack([wu, wl, wd]), np.stack(w), rtol=1e-10)
+    np.testing.assert_allclose(s, s_, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(fr, fr_, rtol=1e-10)
+    np.testing.assert_allclose(np.stack([qi, qg]), np.stack([qi_, qg_]), rtol=1e-10)
+    np.testing.assert_allclose(qsim[:, :, 0], qs, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize("source_type", ["sources", "sources5mm"])
+def test_xaj_float32(source_type):
+    p_and_e, params = synthetic_inputs(0, 730, 5)
+    q64, _ = xaj(p_and_e, params, warmup_length=365, source_type=source_type)
+    q32, _ = xaj(
+        p_and_e,
+        params,
+        warmup_length=365,
+        source_type=source_type,
+        dtype=np.float32,
+    )
+    assert q32.dtype == np.float32
+    # peak flows should be the same with 3-4 significant digits
+    np.testing.assert_allclose(q32.max(axis=0), q64.max(axis=0), rtol=1e-3)
+
+
+@pytest.mark.filterwarnings("error")
+def test_xaj_ki_zero():
+    # KI's range starts from 0, and sources doesn't need anything divided by KI
+    p_and_e, params = synthetic_inputs(0, 60, 3)
+    params[:, MODEL_PARAM_DICT["xaj"]["param_name"].index("KI")] = 0.0
+    qsim, _ = xaj(p_and_e, params, warmup_length=0)
+    assert np.isfinite(qsim).all()
+
+
+def test_xaj_zero_lag():
+    # users may set their own ranges; with L in [0, 0.5] the lag of all basins is 0
+    p_and_e, params = synthetic_inputs(4, 60, 3)
+    param_range = dict(MODEL_PARAM_DICT["xaj"]["param_range"], L=[0.0, 0.5])
+    # with CS = 0 the streamflow is just the total inflow of the channel system
+    qt, _ = xaj(
+        p_and_e,
+        params,
+        warmup_length=0,
+        xaj={"param_range": dict(param_range, CS=[0.0, 0.0])},
+    )
+    qsim, _ = xaj(p_and_e, params, warmup_length=0, xaj={"param_range": param_range})
+    cs = param_range["CS"][0] + params[:, 11] * (
+        param_range["CS"][1] - param_range["CS"][0]
+    )
+    qs = np.zeros(qt.shape[1:])
+    for i in range(qt.shape[0]):
+        # the outflow before the first period is 0
+        qs = cs[:, None] * qs + (1 - cs[:, None]) * qt[i]
+        np.testing.assert_allclose(qsim[i], qs, rtol=1e-10)
+
+
+@pytest.mark.parametrize("name", ["xaj", "xaj_mz"])
+@pytest.mark.parametrize("source_book", ["HF", "EH"])
+def test_xaj_sources5mm_batch_same_as_single_basin(source_book, name):
+    # the runoff of each basin is divided to its own number of 5mm pieces and
+    # each basin has its own unit hydrograph, so a basin's result doesn't depend on the other basins in the batch
+    p_and_e, params = synthetic_inputs(1, 300, 4)
+    p_and_e[:, 0, 0] *= 0.1
+    kwargs = dict(
+        warmup_length=30,
+        name=name,
+        source_type="sources5mm",
+        source_book=source_book,
+        time_interval_hours=3,
+    )
+    qsim, _ = xaj(p_and_e, params, **kwargs)
+    for j in range(4):
+        qsim_j, _ = xaj(p_and_e[:, j : j + 1], params[j : j + 1], **kwargs)
+        np.testing.assert_allclose(qsim[:, j], qsim_j[:, 0], rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("source_type", ["sources", "sources5mm"])
+def test_xaj_basin_blocks(source_type, monkeypatch):
+    p_and_e, params = synthetic_inputs(2, 300, 5)
+    # all basins in one block
+    monkeypatch.setattr(xaj_module, "basin_block", lambda n_basin: n_basin)
+    qsim, es = xaj(p_and_e, params, warmup_length=30, source_type=source_type)
+    # the block size is set explicitly as basin_block depends on the number of threads;
+    # with 2 basins in a block, the last block is smaller than the others
+    for block in [1, 2]:
+        monkeypatch.setattr(xaj_module, "basin_block", lambda n_basin: block)
+        qsim_, es_ = xaj(p_and_e, params, warmup_length=30, source_type=source_type)
+        np.testing.assert_array_equal(qsim, qsim_)
+        np.testing.assert_array_equal(es, es_)
+
+
+def test_compile_kernels():
+    kernels = [
+        xaj_numba.generation_core,
+        xaj_numba.xaj_core,
+        xaj_numba.sources5mm_core,
+        xaj_numba.linear_reservoir_route,
+        xaj_numba.csl_route,
+    ]
+    xaj_numba.compile_kernels(dtypes=(np.float64,))
+    signatures = [list(kernel.signatures) for kernel in kernels]
+    # a batch of basins doesn't need any signature which isn't compiled in advance
+    p_and_e, params = synthetic_inputs(5, 30, 3)
+    for source_type in ["sources", "sources5mm"]:
+        xaj(p_and_e, params, warmup_length=0, source_type=source_type)
+    assert [list(kernel.signatures) for kernel in kernels] == signatures
+
+
+def test_xaj_num_threads():
+    p_and_e, params = synthetic_inputs(3, 200, 3)
+    num_threads = numba.get_num_threads()
+    qsim, _ = xaj(p_and_e, params, warmup_length=30)
+    qsim_, _ = xaj(p_and_e, params, warmup_length=30, num_threads=1)
+    np.testing.assert_array_equal(qsim, qsim_)
+    # the number of threads is restored after the run
+    assert numba.get_num_threads() == num_threads